@@ -1,17 +1,27 @@
 import os
 import json
-import pickle
-import joblib
-import pandas as pd
-from flask import Flask, jsonify, request
+import functools
+import operator
+import threading
+from types import SimpleNamespace
+import fastjsonschema
+import orjson
+import zstandard
+from flask import Flask, Response, abort, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from peewee import (
     Model, IntegerField, FloatField,
-    TextField, IntegrityError,BooleanField
+    TextField, BooleanField, BlobField
 )
-from playhouse.shortcuts import model_to_dict
 from playhouse.db_url import connect
+from migrate_db import needs_migration
+from prediction_writer import PredictionWriter
 import warnings
-warnings.filterwarnings('ignore')
+# Only silence what we know is noise: loading the pipeline under a
+# different scikit-learn than it was trained with, and sklearn deprecations.
+# (Matched by message, importing sklearn.exceptions would import all of sklearn.)
+warnings.filterwarnings('ignore', message='Trying to unpickle estimator', category=UserWarning)
+warnings.filterwarnings('ignore', category=FutureWarning, module='sklearn')
 
 
 
@@ -21,11 +31,65 @@ warnings.filterwarnings('ignore')
 # The connect function checks if there is a DATABASE_URL env var.
 # If it exists, it uses it to connect to a remote postgres db.
 # Otherwise, it connects to a local sqlite db stored in predictions.db.
-DB = connect(os.environ.get('DATABASE_URL') or 'sqlite:///predictions.db')
+DATABASE_URL = os.environ.get('DATABASE_URL') or 'sqlite:///predictions.db'
+
+# WAL lets /list-db-contents read while predictions are being written,
+# and synchronous=normal only fsyncs at checkpoints instead of every commit.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,  # 64MB
+    'temp_store': 'memory',
+    'foreign_keys': 1,
+    'mmap_size': 268435456,  # 256MB
+}
+
+if DATABASE_URL.startswith('sqlite'):
+    DB = connect(DATABASE_URL, pragmas=SQLITE_PRAGMAS)
+else:
+    DB = connect(DATABASE_URL)
+
+class CompressedTextField(BlobField):
+    """
+        Text stored as a zstd-compressed blob.
+
+        Rows written before the column was compressed are returned as they
+        were stored: plain text on sqlite, utf-8 bytes on postgres once
+        migrate_db.py has converted the column.
+    """
+
+    ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+    def __init__(self, *args, level=3, **kwargs):
+        self.level = level
+        # zstd (de)compressors can't be shared between threads
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def _codec(self):
+        local = self._local
+        if not hasattr(local, 'compressor'):
+            local.compressor = zstandard.ZstdCompressor(level=self.level)
+            local.decompressor = zstandard.ZstdDecompressor()
+        return local
+
+    def db_value(self, value):
+        if isinstance(value, str):
+            value = self._codec().compressor.compress(value.encode('utf-8'))
+        return super().db_value(value)
+
+    def python_value(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        if not value.startswith(self.ZSTD_MAGIC):
+            return value.decode('utf-8')
+        return self._codec().decompressor.decompress(value).decode('utf-8')
+
 
 class Prediction(Model):
     observation_id = TextField(unique=True)
-    observation = TextField()
+    observation = CompressedTextField()
     label = BooleanField()
     
     class Meta:
@@ -34,39 +98,127 @@ class Prediction(Model):
 
 DB.create_tables([Prediction], safe=True)
 
+
+# An old postgres text column would store the compressed blobs as escaped
+# text, refuse to start rather than write those.
+if needs_migration(DB, Prediction._meta.table_name):
+    raise RuntimeError(
+        'The observation column is still text, run `python migrate_db.py` first')
+
+# Don't hold a connection across gunicorn's fork, each worker opens its own
+DB.close()
+
+# Concurrent predictions are committed together in one transaction
+# by a background thread, each request still waits for its own row.
+PREDICTION_WRITER = PredictionWriter(Prediction)
+
 # End database stuff
 ########################################
 
 ########################################
-# Unpickle the previously-trained model
+# Load the previously-trained model
 
 
 with open('columns.json') as fh:
     columns = json.load(fh)
 
-pipeline = joblib.load('pipeline.pickle')
+COLS = tuple(columns)
+# Pulls the feature values out of an observation, in COLS order, in one C call
+FEATURE_GETTER = operator.itemgetter(*COLS)
 
-with open('dtypes.pickle', 'rb') as fh:
-    dtypes = pickle.load(fh)
 
+# Non-scikit-learn types the pipeline is allowed to contain
+PIPELINE_TRUSTED_TYPES = [
+    'custom_transformers.lowercase_transformer.LowercaseTransformer',
+    'numpy.dtype',
+]
 
-# End model un-pickling
-########################################
 
-########################################
-# Input validation functions
+def load_model():
+    """
+        Loads the pipeline and builds what the prediction path needs from it.
+    """
+    # Imported here, scikit-learn and pandas are most of our import time
+    import pandas as pd
+    import skops.io
+    from row_predictor import build_row_predictor
+
+    # skops only rebuilds the types it is told to trust, unlike pickle
+    # which will run whatever the file asks it to.
+    pipeline = skops.io.load('pipeline.skops', trusted=PIPELINE_TRUSTED_TYPES)
+
+    # We only ever predict one row at a time, spreading it over a joblib
+    # worker pool costs more than it saves.
+    estimator = pipeline.steps[-1][1]
+    if getattr(estimator, 'n_jobs', None) not in (None, 1):
+        estimator.set_params(n_jobs=1)
+
+    # {column: dtype name}, pandas takes the names as they are
+    with open('dtypes.json') as fh:
+        dtypes = json.load(fh)
+
+    return SimpleNamespace(
+        pipeline=pipeline,
+        dtypes=dtypes,
+        # One-row frame with the training dtypes. Requests copy it and fill in
+        # their values instead of building a new DataFrame from a dict.
+        template=pd.DataFrame({c: pd.Series([None], dtype=dtypes[c]) for c in COLS}),
+        # Specialised single-row version of pipeline.predict, None if the
+        # pipeline has steps it can't inline.
+        predict_row=build_row_predictor(pipeline, COLS),
+    )
 
 
-def check_valid_column(observation):
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
     """
-        Validates that our observation only has valid columns
-        
-        Returns:
-        - assertion value: True if all provided columns are valid, False otherwise
-        - error message: empty if all provided columns are valid, False otherwise
+        Loads the model on first use, so the app starts (and rejects invalid
+        requests) without paying for it.
     """
-    
-    valid_columns = {
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_model()
+    return _model
+
+
+def features_to_frame(features):
+    """
+        Turns a single observation's feature values into a dataframe that will work with the pipeline.
+    """
+    # The copy has to be deep, iat writes into the template's blocks otherwise.
+    obs = get_model().template.copy()
+    for i, value in enumerate(features):
+        obs.iat[0, i] = value
+    return obs
+
+
+@functools.lru_cache(maxsize=4096, typed=True)
+def predict_features(*features):
+    """
+        Predicts the label of an observation given its feature values in COLS order.
+
+        The pipeline is deterministic, so retried or repeated observations are
+        answered from the cache. typed=True keeps e.g. True and 1 apart, they
+        lowercase to different categories.
+    """
+    model = get_model()
+    if model.predict_row is not None:
+        return bool(model.predict_row(features))
+    return bool(model.pipeline.predict(features_to_frame(features))[0])
+
+
+# End model loading
+########################################
+
+########################################
+# Input validation functions
+
+VALID_COLUMNS = frozenset({
     'observation_id',
     'Type',
     'Date',
@@ -81,17 +233,61 @@ def check_valid_column(observation):
     'Object of inspection',
     'Inspection involving more than just outerwear',
     'Enforcement station'
-    }
+})
+
+# Ordered so error messages list the allowed values consistently
+CATEGORIES = {
+    "Type": ['Entity inspection', 'Entity and Spaceship search','Spaceship search'],
+#    "Part of a standard enforcement protocol": ['False', 'nan', 'True'],
+    "Reproduction": ['Asexual', 'Sexual'],
+    "Age range": ['Senior', 'Adult', 'Young Adult', 'Young', 'Child']
+}
+
+VALID_CATEGORY_MAP = {key: frozenset(values) for key, values in CATEGORIES.items()}
+
+# Allowed values as they appear in error messages
+ALLOWED_STR = {
+    key: ",".join("'{}'".format(v) for v in values)
+    for key, values in CATEGORIES.items()
+}
+
+# Same rules as the check functions below, plus scalar-only values and a
+# non-empty string observation_id, compiled once into straight-line python.
+OBSERVATION_SCHEMA = {
+    'type': 'object',
+    'required': sorted(VALID_COLUMNS),
+    'additionalProperties': False,
+    'properties': {
+        'observation_id': {'type': 'string', 'minLength': 1},
+        **{
+            column: {'enum': CATEGORIES[column]} if column in CATEGORIES
+            else {'type': ['string', 'number', 'boolean', 'null']}
+            for column in VALID_COLUMNS - {'observation_id'}
+        },
+    },
+}
+
+validate_observation = fastjsonschema.compile(OBSERVATION_SCHEMA)
+
+
+def check_valid_column(observation):
+    """
+        Validates that our observation only has valid columns
+        
+        Returns:
+        - assertion value: True if all provided columns are valid, False otherwise
+        - error message: empty if all provided columns are valid, False otherwise
+    """
     
-    keys = set(observation.keys())
+    keys = observation.keys()
     
-    if len(valid_columns - keys) > 0: 
-        missing = valid_columns - keys
-        error = "Missing columns: {}".format(missing)
+    if len(VALID_COLUMNS - keys) > 0: 
+        missing = VALID_COLUMNS - keys
+        error = "Missing columns: {}".format(set(missing))
         return False, error
     
-    if len(keys - valid_columns) > 0: 
-        extra = keys - valid_columns
+    if len(keys - VALID_COLUMNS) > 0: 
+        extra = keys - VALID_COLUMNS
         error = "Unrecognized columns provided: {}".format(extra)
         return False, error    
 
@@ -107,91 +303,158 @@ def check_categorical_values(observation):
         - error message: empty if all provided columns are valid, False otherwise
     """
     
-    valid_category_map = {
-        "Type": ['Entity inspection', 'Entity and Spaceship search','Spaceship search'],
-    #    "Part of a standard enforcement protocol": ['False', 'nan', 'True'],
-        "Reproduction": ['Asexual', 'Sexual'],
-        "Age range": ['Senior', 'Adult', 'Young Adult', 'Young', 'Child']
-    }
-    
-    for key, valid_categories in valid_category_map.items():
+    for key, valid_categories in VALID_CATEGORY_MAP.items():
         if key in observation:
             value = observation[key]
-            if value not in valid_categories:
+            # every category is a string, and lists/dicts can't be hashed
+            if not isinstance(value, str) or value not in valid_categories:
                 error = "Invalid value provided for {}: {}. Allowed values are: {}".format(
-                    key, value, ",".join(["'{}'".format(v) for v in valid_categories]))
+                    key, value, ALLOWED_STR[key])
                 return False, error
         else:
-            error = "Categorical field {} missing"
+            error = "Categorical field {} missing".format(key)
             return False, error
 
     return True, ""
 
+def check_observation(observation):
+    """
+        Validates the observation against the compiled schema
+        
+        Returns:
+        - assertion value: True if the observation is valid, False otherwise
+        - error message: empty if the observation is valid, the reason otherwise
+    """
+    
+    try:
+        validate_observation(observation)
+    except fastjsonschema.JsonSchemaValueException as e:
+        # Only rejected requests get here, so it's fine to rerun the
+        # detailed checks to report the same messages as always
+        if isinstance(observation, dict):
+            for check in (check_valid_column, check_categorical_values):
+                ok, error = check(observation)
+                if not ok:
+                    return False, error
+        return False, e.message
+
+    return True, ""
+
 
 ########################################
 # Begin webserver stuff
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+        JSON provider that swaps Flask's stdlib json codec for orjson.
+
+        jsonify and request.get_json keep working as before, they just
+        go through orjson's (much faster) encoder and decoder.
+    """
+
+    # Keys sorted like DefaultJSONProvider.sort_keys, so responses don't change shape
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+
+# gthread workers reuse their threads, so each request opens and closes its
+# own connection rather than keeping one per thread that the server may drop.
+@app.before_request
+def _db_connect():
+    # /predict stores through PREDICTION_WRITER's thread and its connection
+    if request.endpoint != 'predict':
+        DB.connect(reuse_if_open=True)
+
+
+@app.teardown_request
+def _db_close(exc):
+    if not DB.is_closed():
+        DB.close()
+
+
+def read_json():
+    """
+        Reads the request body once and parses it with orjson.
+
+        Returns:
+        - the raw body as text, ready to be stored
+        - the parsed observation
+    """
+    raw = request.get_data()
+    try:
+        observation = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        abort(400, 'Request body is not valid JSON')
+    return raw.decode('utf-8'), observation
 
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    # Flask provides a deserialization convenience function called
-    # get_json that will work if the mimetype is application/json.
-    observation = request.get_json()
-    
-    ## a single observation into a dataframe that will work with a pipeline.
-    obs = pd.DataFrame([observation])#.astype(dtypes)
-
-    columns_ok, error = check_valid_column(observation)
-    if not columns_ok:
-        response = {'error': error}
-        return jsonify(response)
+    raw, observation = read_json()
 
-    categories_ok, error = check_categorical_values(observation)
-    if not categories_ok:
+    observation_ok, error = check_observation(observation)
+    if not observation_ok:
         response = {'error': error}
         return jsonify(response)
     
-    _id = obs['observation_id'].values[0]    
+    _id = observation['observation_id']
     ## Now get ourselves an actual prediction of the positive class.
-    label = pipeline.predict(obs)[0]
-    response = {'observation_id':_id,'label': bool(label)}
-    p = Prediction(
-        observation_id=_id,
-        label=label,
-        observation=request.data
-    )
-    try:
-        p.save()
-    except IntegrityError:
+    label = predict_features(*FEATURE_GETTER(observation))
+    response = {'observation_id':_id,'label': label}
+    if not PREDICTION_WRITER.write(_id, label, raw):
         error_msg = 'Observation ID: "{}" already exists'.format(_id)
         response['error'] = error_msg
         print(error_msg)
-        DB.rollback()
     return jsonify(response)
 
 
 @app.route('/update', methods=['POST'])
 def update():
-    observation = request.get_json()
-    obs = pd.DataFrame([observation])#, columns=columns).astype(dtypes)
-    try:
-        p = Prediction.get(Prediction.observation_id == obs['observation_id'].values[0])
-        p.label = str(obs['label'].values[0])
-        p.save()
-        response = {'observation_id':obs['observation_id'].values[0],'label': bool(obs['label'].values[0])}
-        return jsonify(response)
-    except Prediction.DoesNotExist:
-        error_msg = 'Observation ID: "{}" does not exist'.format(obs['observation_id'].values[0])
+    _, observation = read_json()
+    _id = observation['observation_id']
+    # A single UPDATE, no need to load the row into a model instance first
+    updated = (Prediction
+               .update(label=str(observation['label']))
+               .where(Prediction.observation_id == _id)
+               .execute())
+    if not updated:
+        error_msg = 'Observation ID: "{}" does not exist'.format(_id)
         return jsonify({'error': error_msg})
+    response = {'observation_id':_id,'label': bool(observation['label'])}
+    return jsonify(response)
 
 
 @app.route('/list-db-contents')
 def list_db_contents():
-    return jsonify([
-        model_to_dict(obs) for obs in Prediction.select()
-    ])
+    def stream(rows_per_chunk=1000):
+        # Rows come straight off the cursor as dicts and are encoded as they
+        # go, so the table is never held in memory as a list of models.
+        # This runs after the request is torn down, so it needs its own connection.
+        with DB.connection_context():
+            yield b'['
+            separator = b''
+            chunk = []
+            for row in Prediction.select().dicts().iterator():
+                chunk.append(orjson.dumps(row, option=orjson.OPT_SORT_KEYS))
+                if len(chunk) == rows_per_chunk:
+                    yield separator + b','.join(chunk)
+                    separator = b','
+                    chunk = []
+            if chunk:
+                yield separator + b','.join(chunk)
+            yield b']'
+
+    return Response(stream(), mimetype='application/json')
 
 
 # End webserver stuff
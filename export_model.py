@@ -0,0 +1,29 @@
+"""
+Converts the artifacts written by HCKT06_template.ipynb (pipeline.pickle and
+dtypes.pickle) into the formats app.py loads (pipeline.skops and dtypes.json).
+
+Run it from the repository root after every retrain:
+
+    python export_model.py
+"""
+import json
+import pickle
+import zipfile
+
+import joblib
+import skops.io
+
+
+def export_model(pipeline_path='pipeline.pickle', dtypes_path='dtypes.pickle',
+                 skops_path='pipeline.skops', json_path='dtypes.json'):
+    pipeline = joblib.load(pipeline_path)
+    skops.io.dump(pipeline, skops_path, compression=zipfile.ZIP_DEFLATED)
+
+    with open(dtypes_path, 'rb') as fh:
+        dtypes = pickle.load(fh)
+    with open(json_path, 'w') as fh:
+        json.dump({column: str(dtype) for column, dtype in dtypes.items()}, fh)
+
+
+if __name__ == '__main__':
+    export_model()
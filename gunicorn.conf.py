@@ -0,0 +1,15 @@
+import os
+
+# Railway tells us which port to listen on
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 5000))
+
+# Import app.py once in the master process. The model itself is loaded
+# lazily by each worker on its first prediction, so workers start serving
+# (and rejecting invalid requests) straight away.
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# Each worker serves several requests at once, so a request waiting on
+# the database doesn't hold up the predictions behind it.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
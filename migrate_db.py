@@ -0,0 +1,45 @@
+"""
+Converts a Postgres database created before observations were stored
+compressed: the observation column goes from text to bytea, and the existing
+rows are kept as their UTF-8 bytes (app.py reads those as they are).
+
+Run it once against the deployed database, before deploying a version of
+app.py that stores compressed observations:
+
+    DATABASE_URL=postgres://... python migrate_db.py
+
+SQLite needs nothing: it stores blobs in the old text column as they are.
+"""
+import os
+
+from peewee import PostgresqlDatabase
+from playhouse.db_url import connect
+
+
+def needs_migration(db, table='prediction'):
+    if not isinstance(db, PostgresqlDatabase):
+        return False
+    column_types = {c.name: c.data_type.lower() for c in db.get_columns(table)}
+    return column_types.get('observation') == 'text'
+
+
+def migrate_observation_column(db, table='prediction'):
+    """
+    Returns True if the column was converted, False if there was nothing to do.
+    """
+    if not needs_migration(db, table):
+        return False
+    with db.atomic():
+        db.execute_sql(
+            'ALTER TABLE "{}" ALTER COLUMN "observation" TYPE bytea '
+            'USING convert_to("observation", \'UTF8\')'.format(table))
+    return True
+
+
+if __name__ == '__main__':
+    db = connect(os.environ['DATABASE_URL'])
+    if migrate_observation_column(db):
+        print('Converted the observation column to bytea')
+    else:
+        print('Nothing to migrate')
+    db.close()
@@ -0,0 +1,113 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+from peewee import IntegrityError
+
+
+class PredictionWriter:
+    """
+        Writes predictions to the database from a background thread, grouping
+        whatever requests arrive together into one transaction.
+
+        Each request still waits for its own row to be committed and gets the
+        outcome back, so only the commit (and its fsync) is shared between
+        requests. While one transaction commits, the next batch queues up.
+    """
+
+    def __init__(self, model, batch_size=500, maxsize=10000):
+        self.model = model
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def write(self, observation_id, label, observation):
+        """
+            Stores a prediction, blocking until it is committed.
+
+            Returns:
+            - True if the prediction was stored, False if a prediction with
+              the same observation_id already exists
+
+            Any database error is raised here, in the request that caused it.
+        """
+        future = Future()
+        row = {
+            'observation_id': observation_id,
+            'label': label,
+            'observation': observation,
+        }
+        self._ensure_started()
+        self._queue.put((row, future))
+        return future.result()
+
+    def _ensure_started(self):
+        # Started lazily so a worker forked from a preloaded app gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='prediction-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        # Block for the first row, then take whatever else is already waiting
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, row):
+        """
+            Inserts one row, ignoring a conflicting observation_id.
+
+            Returns:
+            - True if the row was inserted, False if its observation_id already exists
+        """
+        model = self.model
+        query = model.insert(**row).on_conflict_ignore()
+        if query.as_rowcount().execute() > 0:
+            return True
+        # sqlite's OR IGNORE also skips rows breaking other constraints
+        # (e.g. NOT NULL), only call it a duplicate if the id is really taken.
+        observation_id = row['observation_id']
+        if model.select().where(model.observation_id == observation_id).exists():
+            return False
+        raise IntegrityError('Prediction "{}" was not stored'.format(observation_id))
+
+    def _write(self, batch):
+        try:
+            with self.model._meta.database.atomic():
+                results = [self._insert(row) for row, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Retry each row in its own transaction, one bad row mustn't
+            # take the rest of the batch down with it.
+            for item in batch:
+                self._write([item])
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run(self):
+        database = self.model._meta.database
+        while True:
+            batch = self._next_batch()
+            try:
+                # A fresh connection per batch, so one dropped by the server
+                # (or a proxy in front of it) only fails the batch it was used for.
+                with database.connection_context():
+                    self._write(batch)
+            except Exception as e:
+                # _write already reports database errors to each request,
+                # this only guards against leaving one waiting forever.
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -0,0 +1,191 @@
+import operator
+import threading
+
+import numpy as np
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from custom_transformers.lowercase_transformer import LowercaseTransformer
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _compile_lowercase(step, columns):
+    lowered = [c in step.columns for c in columns]
+
+    def lowercase(values):
+        return [str(v).lower() if low else v for v, low in zip(values, lowered)]
+    return lowercase
+
+
+def _compile_imputer(step, columns):
+    missing = step.missing_values
+    if step.add_indicator or not _is_missing(missing):
+        return None
+    statistics = list(step.statistics_)
+    if len(statistics) != len(columns) or any(_is_missing(s) for s in statistics):
+        # all-missing features get dropped by the imputer, not worth inlining
+        return None
+
+    if step.strategy in ('mean', 'median'):
+        # sklearn converts numeric columns to float before looking for missing
+        # values, so strings like "nan" get imputed too.
+        def impute(values):
+            out = [float('nan') if v is None else float(v) for v in values]
+            return [s if v != v else v for v, s in zip(out, statistics)]
+        return impute
+
+    def impute(values):
+        return [s if _is_missing(v) else v for v, s in zip(values, statistics)]
+    return impute
+
+
+def _compile_scaler(step, columns):
+    mean = step.mean_ if step.with_mean else None
+    scale = step.scale_ if step.with_std else None
+
+    def scale_values(values):
+        out = [float(v) for v in values]
+        if mean is not None:
+            out = [v - m for v, m in zip(out, mean)]
+        if scale is not None:
+            out = [v / s for v, s in zip(out, scale)]
+        return out
+    return scale_values
+
+
+def _compile_onehot(step):
+    """
+        Returns (width, encode) where encode(values, out) sets the one-hot
+        positions of out, or None if the encoder can't be inlined.
+    """
+    if step.drop_idx_ is not None or getattr(step, '_infrequent_enabled', False):
+        return None
+    if step.handle_unknown != 'ignore':
+        return None
+
+    lookups = []
+    offset = 0
+    for categories in step.categories_:
+        lookups.append({c: offset + i for i, c in enumerate(categories)})
+        offset += len(categories)
+
+    def encode(values, out):
+        for v, lookup in zip(values, lookups):
+            i = lookup.get(v)
+            if i is not None:
+                out[i] = 1.0
+    return offset, encode
+
+
+_VALUE_STEPS = {
+    LowercaseTransformer: _compile_lowercase,
+    SimpleImputer: _compile_imputer,
+    StandardScaler: _compile_scaler,
+}
+
+
+def _compile_group(transformer, columns):
+    """
+        Compiles one ColumnTransformer entry into (width, fill), where
+        fill(values, out) writes the transformed values into out.
+    """
+    if isinstance(transformer, Pipeline):
+        steps = [step for _, step in transformer.steps]
+    else:
+        steps = [transformer]
+
+    encoder = None
+    if isinstance(steps[-1], OneHotEncoder):
+        encoder = _compile_onehot(steps.pop())
+        if encoder is None:
+            return None
+
+    maps = []
+    for step in steps:
+        compile_step = _VALUE_STEPS.get(type(step))
+        fn = compile_step(step, columns) if compile_step else None
+        if fn is None:
+            return None
+        maps.append(fn)
+
+    def apply_maps(values):
+        for fn in maps:
+            values = fn(values)
+        return values
+
+    if encoder is not None:
+        width, encode = encoder
+
+        def fill(values, out):
+            encode(apply_maps(values), out)
+        return width, fill
+
+    def fill(values, out):
+        out[:] = apply_maps(values)
+    return len(columns), fill
+
+
+def _getter(indices):
+    # itemgetter returns a bare value rather than a tuple for a single index
+    if len(indices) == 1:
+        i, = indices
+        return lambda values: (values[i],)
+    return operator.itemgetter(*indices)
+
+
+def build_row_predictor(pipeline, columns):
+    """
+        Compiles the fitted pipeline into a function predicting a single
+        observation, given as a sequence of feature values in `columns` order,
+        skipping pandas and the generic ColumnTransformer dispatch.
+
+        Returns None if the pipeline has a step we don't know how to inline,
+        in which case callers should stick to pipeline.predict.
+    """
+    if not isinstance(pipeline, Pipeline) or len(pipeline.steps) != 2:
+        return None
+    preprocessor = pipeline.steps[0][1]
+    estimator = pipeline.steps[-1][1]
+    if not isinstance(preprocessor, ColumnTransformer):
+        return None
+
+    position = {c: i for i, c in enumerate(columns)}
+    groups = []
+    n_features = 0
+    for _, transformer, group_columns in preprocessor.transformers_:
+        if isinstance(transformer, str) and transformer == 'drop':
+            continue
+        if isinstance(transformer, str) or not all(c in position for c in group_columns):
+            return None
+        compiled = _compile_group(transformer, group_columns)
+        if compiled is None:
+            return None
+        width, fill = compiled
+        get_values = _getter([position[c] for c in group_columns])
+        groups.append((get_values, slice(n_features, n_features + width), fill))
+        n_features += width
+
+    if getattr(estimator, 'n_features_in_', n_features) != n_features:
+        return None
+
+    # Tree models cast their input to float32 anyway, feeding it directly saves a copy.
+    dtype = np.float32 if hasattr(estimator, 'estimators_') or hasattr(estimator, 'tree_') else np.float64
+
+    local = threading.local()
+
+    def predict_row(values):
+        buf = getattr(local, 'buf', None)
+        if buf is None:
+            buf = local.buf = np.empty((1, n_features), dtype=dtype)
+        buf.fill(0)
+        row = buf[0]
+        for get_values, span, fill in groups:
+            fill(get_values(values), row[span])
+        return estimator.predict(buf)[0]
+
+    return predict_row
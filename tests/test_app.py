@@ -0,0 +1,90 @@
+import importlib
+import pathlib
+import sys
+
+import pytest
+
+from migrate_db import migrate_observation_column
+
+ROOT = pathlib.Path(__file__).parents[1]
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    # app.py connects to DATABASE_URL and reads its files relative to the
+    # working directory as it is imported.
+    db_path = tmp_path_factory.mktemp('db') / 'predictions.db'
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('DATABASE_URL', 'sqlite:///{}'.format(db_path))
+        mp.chdir(ROOT)
+        sys.modules.pop('app', None)
+        module = importlib.import_module('app')
+        yield module
+        module.DB.close()
+        sys.modules.pop('app', None)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def test_requests_close_their_connection(app_module, client):
+    app_module.Prediction.create(observation_id='conn', observation='{}', label=True)
+    app_module.DB.close()
+
+    response = client.post('/update', json={'observation_id': 'conn', 'label': False})
+    assert response.get_json() == {'observation_id': 'conn', 'label': False}
+    assert app_module.DB.is_closed()
+
+    response = client.get('/list-db-contents')
+    assert 'conn' in [row['observation_id'] for row in response.get_json()]
+    assert app_module.DB.is_closed()
+
+
+def stored_observation(app_module, observation_id):
+    cursor = app_module.DB.execute_sql(
+        'SELECT observation FROM prediction WHERE observation_id = ?', (observation_id,))
+    return cursor.fetchone()[0]
+
+
+def test_observation_round_trip(app_module):
+    Prediction = app_module.Prediction
+    observation = '{"observation_id": "zstd", "Type": "Spaceship search"}'
+    Prediction.create(observation_id='zstd', observation=observation, label=True)
+
+    assert stored_observation(app_module, 'zstd').startswith(app_module.CompressedTextField.ZSTD_MAGIC)
+    assert Prediction.get(Prediction.observation_id == 'zstd').observation == observation
+
+
+@pytest.mark.parametrize('stored', ['{"old": "text"}', b'{"old": "bytes"}'])
+def test_observation_written_before_compression(app_module, stored):
+    # Plain text as the old sqlite column held it, utf-8 bytes as a
+    # migrated postgres column returns it
+    observation_id = 'old-{}'.format(type(stored).__name__)
+    app_module.DB.execute_sql(
+        'INSERT INTO prediction (observation_id, observation, label) VALUES (?, ?, ?)',
+        (observation_id, stored, True))
+
+    Prediction = app_module.Prediction
+    observation = Prediction.get(Prediction.observation_id == observation_id).observation
+    assert observation == (stored if isinstance(stored, str) else stored.decode('utf-8'))
+
+
+def test_list_db_contents_returns_text_observations(app_module, client):
+    Prediction = app_module.Prediction
+    Prediction.create(observation_id='listed', observation='{"listed": true}', label=False)
+    app_module.DB.execute_sql(
+        'INSERT INTO prediction (observation_id, observation, label) VALUES (?, ?, ?)',
+        ('listed-old', '{"listed": "old"}', True))
+
+    rows = {row['observation_id']: row for row in client.get('/list-db-contents').get_json()}
+    assert rows['listed'] == {
+        'id': rows['listed']['id'], 'observation_id': 'listed',
+        'observation': '{"listed": true}', 'label': False,
+    }
+    assert rows['listed-old']['observation'] == '{"listed": "old"}'
+
+
+def test_sqlite_needs_no_migration(app_module):
+    assert migrate_observation_column(app_module.DB) is False
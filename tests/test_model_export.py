@@ -0,0 +1,28 @@
+import json
+import os
+import pathlib
+import pickle
+
+import joblib
+import pandas as pd
+import skops.io
+
+ROOT = pathlib.Path(__file__).parents[1]
+
+
+def test_skops_pipeline_matches_pickle():
+    # Fails when the notebook retrained pipeline.pickle but export_model.py wasn't rerun
+    path = os.path.join(ROOT, 'pipeline.skops')
+    served = skops.io.load(path, trusted=skops.io.get_untrusted_types(file=path))
+    trained = joblib.load(os.path.join(ROOT, 'pipeline.pickle'))
+
+    X = pd.read_csv(os.path.join(ROOT, 'data', 'train.csv'))
+    assert (served.predict_proba(X) == trained.predict_proba(X)).all()
+
+
+def test_dtypes_json_matches_pickle():
+    with open(os.path.join(ROOT, 'dtypes.pickle'), 'rb') as fh:
+        trained = pickle.load(fh)
+    with open(os.path.join(ROOT, 'dtypes.json')) as fh:
+        served = json.load(fh)
+    assert served == {column: str(dtype) for column, dtype in trained.items()}
@@ -0,0 +1,116 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+from peewee import BooleanField, IntegrityError, Model, SqliteDatabase, TextField
+
+from prediction_writer import PredictionWriter
+
+
+def make_model(path, **connect_params):
+    # A separate database object per writer, like separate gunicorn workers
+    db = SqliteDatabase(path, pragmas={'journal_mode': 'wal'}, timeout=10, **connect_params)
+
+    class Prediction(Model):
+        observation_id = TextField(unique=True)
+        observation = TextField()
+        label = BooleanField()
+
+        class Meta:
+            database = db
+
+    db.create_tables([Prediction], safe=True)
+    return Prediction
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'predictions.db')
+
+
+def test_write_reports_duplicates(db_path):
+    writer = PredictionWriter(make_model(db_path))
+    assert writer.write('a', True, '{}') is True
+    assert writer.write('a', False, '{}') is False
+    assert writer.model.select().count() == 1
+
+
+def test_concurrent_duplicates_across_writers(db_path):
+    writers = [PredictionWriter(make_model(db_path)) for _ in range(2)]
+    ids = ['obs-{}'.format(i) for i in range(50)]
+    results = {i: [] for i in ids}
+    lock = threading.Lock()
+
+    def send(n):
+        writer = writers[n % 2]
+        for i in ids:
+            stored = writer.write(i, True, '{}')
+            with lock:
+                results[i].append(stored)
+
+    threads = [threading.Thread(target=send, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Exactly one request per id is stored, every other one is told it's a duplicate
+    assert all(r.count(True) == 1 and r.count(False) == 7 for r in results.values())
+    assert writers[0].model.select().count() == len(ids)
+
+
+def test_failing_row_does_not_lose_the_batch(db_path):
+    writer = PredictionWriter(make_model(db_path))
+    rows = [
+        {'observation_id': 'good-1', 'label': True, 'observation': '{}'},
+        # not valid UTF-8, so building this insert raises
+        {'observation_id': 'bad', 'label': True, 'observation': b'\xff'},
+        {'observation_id': 'good-2', 'label': False, 'observation': '{}'},
+    ]
+    batch = [(row, Future()) for row in rows]
+
+    writer._write(batch)
+
+    assert batch[0][1].result() is True
+    assert batch[2][1].result() is True
+    with pytest.raises(Exception):
+        batch[1][1].result()
+    stored = [p.observation_id for p in writer.model.select().order_by(writer.model.id)]
+    assert stored == ['good-1', 'good-2']
+
+
+def test_write_raises_database_errors(db_path):
+    writer = PredictionWriter(make_model(db_path))
+    with pytest.raises(Exception):
+        writer.write('bad', True, b'\xff')
+    assert writer.write('good', True, '{}') is True
+
+
+def test_skipped_row_is_not_reported_as_duplicate(db_path):
+    writer = PredictionWriter(make_model(db_path))
+    # OR IGNORE skips the NOT NULL violation without raising, that's no duplicate
+    with pytest.raises(IntegrityError):
+        writer.write('no-label', None, '{}')
+    assert writer.write('no-label', True, '{}') is True
+
+
+
+def test_write_survives_a_dropped_connection(db_path):
+    model = make_model(db_path, check_same_thread=False)
+    db = model._meta.database
+    opened = []
+    connect = db._connect
+
+    def record_connect():
+        conn = connect()
+        opened.append(conn)
+        return conn
+    db._connect = record_connect
+
+    writer = PredictionWriter(model)
+    assert writer.write('a', True, '{}') is True
+    # Like the server closing it, behind peewee's back
+    for conn in opened:
+        conn.close()
+    assert writer.write('b', True, '{}') is True
+    assert model.select().count() == 2
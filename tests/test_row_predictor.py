@@ -0,0 +1,72 @@
+import json
+import math
+import os
+import pathlib
+
+import pandas as pd
+import pytest
+import skops.io
+
+from row_predictor import build_row_predictor
+
+ROOT = pathlib.Path(__file__).parents[1]
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    path = os.path.join(ROOT, 'pipeline.skops')
+    # Our own checked-in model, so trusting everything it contains is fine here
+    return skops.io.load(path, trusted=skops.io.get_untrusted_types(file=path))
+
+
+@pytest.fixture(scope='module')
+def observations():
+    """
+    Training rows as /predict receives them: JSON nulls instead of NaN and
+    plain python scalars instead of numpy ones.
+    """
+    with open(os.path.join(ROOT, 'columns.json')) as fh:
+        columns = json.load(fh)
+    df = pd.read_csv(os.path.join(ROOT, 'data', 'train.csv'))[columns]
+    rows = []
+    for record in df.to_dict('records'):
+        rows.append({
+            c: None if isinstance(v, float) and math.isnan(v) else v
+            for c, v in record.items()
+        })
+    return columns, rows
+
+
+def test_row_predictor_matches_pipeline(pipeline, observations):
+    columns, rows = observations
+    predict_row = build_row_predictor(pipeline, columns)
+    assert predict_row is not None, 'pipeline has a step the row predictor cannot inline'
+
+    expected = pipeline.predict(pd.DataFrame(rows, columns=columns))
+    got = [predict_row(tuple(row[c] for c in columns)) for row in rows]
+
+    mismatches = [i for i, (e, g) in enumerate(zip(expected, got)) if e != g]
+    assert not mismatches, '{} of {} rows differ, first at row {}'.format(
+        len(mismatches), len(rows), mismatches[0])
+
+
+def test_row_predictor_handles_unknown_categories(pipeline, observations):
+    columns, rows = observations
+    predict_row = build_row_predictor(pipeline, columns)
+    row = dict(rows[0], **{'Enforcement station': 'Nowhere', 'Galactic X': None})
+
+    expected = pipeline.predict(pd.DataFrame([row], columns=columns))[0]
+    assert predict_row(tuple(row[c] for c in columns)) == expected
+
+
+
+@pytest.mark.parametrize('value', ['nan', 'NaN', '3.5', True])
+def test_row_predictor_converts_numeric_strings(pipeline, observations, value):
+    # The schema lets any scalar through, sklearn turns these into floats
+    # (and imputes NaN) before the scaler sees them.
+    columns, rows = observations
+    predict_row = build_row_predictor(pipeline, columns)
+    row = dict(rows[0], **{'Galactic X': value})
+
+    expected = pipeline.predict(pd.DataFrame([row], columns=columns))[0]
+    assert predict_row(tuple(row[c] for c in columns)) == expected